@@ -2,16 +2,22 @@ from __future__ import annotations
 
 import argparse
 import csv
-import io
 import os
+import queue
 import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import lru_cache
+from operator import attrgetter
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml.etree import XPath
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 from playwright.sync_api import sync_playwright
 
 
@@ -21,10 +27,43 @@ UA = (
     "Chrome/121.0.0.0 Safari/537.36"
 )
 
-WAIT_MS = 25000
+WAIT_MS = 25000  # tylko na pojawienie się listy tras
+DEFAULT_TIMEOUT_MS = 8000  # pozostałe akcje/selektory na stronie
+NAVIGATION_TIMEOUT_MS = 30000  # page.goto — domyślna wartość Playwrighta
+WORKERS = 4
+SCROLL_WAIT_MS = 1500  # ile czekamy na nowe wiersze po jednym scrollu
+SCROLL_CAP_MS = 5000  # łączny limit czasu scrollowania
 
+# zasoby, których parser nie potrzebuje (z obrazków bierzemy tylko atrybut src)
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+_RE_BLOCKED_URL = re.compile(r"googletagmanager|doubleclick|adservice|analytics")
 
-@dataclass
+_RE_FPD = re.compile(
+    r"(?P<lo>\d+)\s*-\s*(?P<hi>\d+)\s+flights?\s+per\s+day"
+    r"|(?P<one>\d+)\s+flights?\s+per\s+day"
+)
+_RE_DUR = re.compile(r"(\d+)\s*([hm])")
+_RE_LOGO = re.compile(r"/([A-Z0-9]{2})_100px\.png")
+_RE_FLAG = re.compile(r"^([A-Z]{2})\s*-\s*(.+)$")
+
+
+def _cls(name: str) -> str:
+    # odpowiednik CSS ".name" w XPath (dopasowanie całego tokenu klasy)
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+_XP_WRAPPER = XPath(f"//div[{_cls('ff-wrapper')}]")
+_XP_LINK = XPath(f".//div[{_cls('ff-row-name')}]//a[starts-with(@href, $prefix)]")
+_XP_FLAG = XPath(f".//img[{_cls('flag-image')} and @uk-tooltip]")
+_XP_AIRLINE_IMG = XPath(f".//div[{_cls('ff-row-airline')}]//img[{_cls('ff-image-airline')}]")
+_XP_FPD = XPath(f".//*[{_cls('ff-flights-daily')} or {_cls('ff-flights-daily-desktop')}]")
+_XP_DUR = XPath(
+    f".//*[{_cls('ff-row-durationnr')} or {_cls('ff-row-text-durationnr')}]"
+    f" | .//*[{_cls('ff-row-duration')}]//span"
+)
+
+
+@dataclass(slots=True)
 class Row:
     origin_iata: str
     destination_iata: str
@@ -51,147 +90,196 @@ def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat(timespec="seconds")
 
 
+@lru_cache(maxsize=1024)
 def parse_flights_per_day(text: str) -> Tuple[Optional[int], Optional[int]]:
     t = (text or "").strip().lower()
     if not t:
         return None, None
 
-    m = re.search(r"(\d+)\s*-\s*(\d+)\s+flights?\s+per\s+day", t)
-    if m:
-        return int(m.group(1)), int(m.group(2))
-
-    m = re.search(r"(\d+)\s+flight\s+per\s+day", t)
-    if m:
-        x = int(m.group(1))
+    # najczęstszy przypadek ("1 flight per day", "3 flights per day") bez regexa
+    head, _, rest = t.partition(" ")
+    if head.isdecimal() and rest in ("flight per day", "flights per day"):
+        x = int(head)
         return x, x
 
-    m = re.search(r"(\d+)\s+flights\s+per\s+day", t)
-    if m:
-        x = int(m.group(1))
-        return x, x
+    m = _RE_FPD.search(t)
+    if not m:
+        return None, None
 
-    return None, None
+    if m.group("one"):
+        x = int(m.group("one"))
+        return x, x
+    return int(m.group("lo")), int(m.group("hi"))
 
 
+@lru_cache(maxsize=1024)
 def parse_duration_minutes(text: str) -> Optional[int]:
     t = (text or "").strip().lower()
     if not t:
         return None
 
-    hours = 0
-    mins = 0
-
-    mh = re.search(r"(\d+)\s*h", t)
-    if mh:
-        hours = int(mh.group(1))
-
-    mm = re.search(r"(\d+)\s*m", t)
-    if mm:
-        mins = int(mm.group(1))
-
-    total = hours * 60 + mins
+    # jeden przebieg; pierwsza liczba z "h" i pierwsza z "m", niezależnie od kolejności
+    # ("2 hours 10 minutes", "10m 2h")
+    hours: Optional[int] = None
+    mins: Optional[int] = None
+    for m in _RE_DUR.finditer(t):
+        if m.group(2) == "h":
+            if hours is None:
+                hours = int(m.group(1))
+        elif mins is None:
+            mins = int(m.group(1))
+        if hours is not None and mins is not None:
+            break
+
+    total = (hours or 0) * 60 + (mins or 0)
     return total if total > 0 else None
 
 
 def extract_airline_iata_from_logo(url: str) -> str:
     if not url:
         return ""
-    m = re.search(r"/([A-Z0-9]{2})_100px\.png", url)
+    m = _RE_LOGO.search(url)
     return m.group(1) if m else ""
 
 
-def extract_country_and_airport_from_flag(wrapper: BeautifulSoup) -> Tuple[str, str]:
-    img = wrapper.select_one("img.flag-image[uk-tooltip]")
-    if not img:
+def _first(xpath: XPath, el: lxml.html.HtmlElement, **kw) -> Optional[lxml.html.HtmlElement]:
+    found = xpath(el, **kw)
+    return found[0] if found else None
+
+
+def _text(el: lxml.html.HtmlElement, sep: str = "") -> str:
+    # jak BeautifulSoup get_text(sep, strip=True); liść ma tylko jeden węzeł tekstowy
+    if not len(el):
+        return (el.text or "").strip()
+    return sep.join(s for s in (s.strip() for s in el.itertext()) if s)
+
+
+def extract_country_and_airport_from_flag(wrapper: lxml.html.HtmlElement) -> Tuple[str, str]:
+    img = _first(_XP_FLAG, wrapper)
+    if img is None:
         return "", ""
     tip = (img.get("uk-tooltip") or "").strip()
-    m = re.match(r"^([A-Z]{2})\s*-\s*(.+)$", tip)
+    m = _RE_FLAG.match(tip)
     if not m:
         return "", ""
     return m.group(1), m.group(2).strip()
 
 
-def fetch_rendered_html(page, airport_iata: str) -> str:
-    url = f"https://www.flightsfrom.com/{airport_iata}"
-    page.goto(url, wait_until="domcontentloaded")
+def block_unneeded(route) -> None:
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or _RE_BLOCKED_URL.search(req.url):
+        route.abort()
+    else:
+        route.continue_()
 
+
+def wait_for_routes(page, airport_iata: str) -> None:
     # czekamy aż lista tras się pojawi
     page.wait_for_selector(".ff-wrapper", timeout=WAIT_MS)
-    page.wait_for_selector(f'a[href^="/{airport_iata}-"]', timeout=WAIT_MS)
+    page.wait_for_selector(f'a[href^="/{airport_iata}-"]')
+
 
-    # scroll — na wypadek lazy-load
-    for _ in range(7):
+def fetch_rendered_html(page, airport_iata: str) -> str:
+    url = f"https://www.flightsfrom.com/{airport_iata}"
+    page.goto(url, wait_until="domcontentloaded")
+
+    # lista tras się nie wyrenderowała — przeładuj i poczekaj jeszcze raz;
+    # timeout samego goto nie jest ponawiany
+    try:
+        wait_for_routes(page, airport_iata)
+    except PlaywrightTimeoutError:
+        print(f"[RETRY] {airport_iata}: route list timeout, reloading", file=sys.stderr)
+        page.goto(url, wait_until="domcontentloaded")
+        wait_for_routes(page, airport_iata)
+
+    # scroll — na wypadek lazy-load; kończymy, gdy liczba wierszy przestaje rosnąć
+    deadline = time.monotonic() + SCROLL_CAP_MS / 1000
+    count = page.locator(".ff-wrapper").count()
+    while True:
+        left_ms = int((deadline - time.monotonic()) * 1000)
+        if left_ms <= 0:
+            break
         page.mouse.wheel(0, 8000)
-        page.wait_for_timeout(600)
+        try:
+            page.wait_for_function(
+                "n => document.querySelectorAll('.ff-wrapper').length > n",
+                arg=count,
+                timeout=min(SCROLL_WAIT_MS, left_ms),
+            )
+        except PlaywrightTimeoutError:
+            break
+        count = page.locator(".ff-wrapper").count()
 
     return page.content()
 
 
 def parse_rows(html: str, origin: str) -> List[Row]:
-    soup = BeautifulSoup(html, "lxml")
-    scraped_at = now_iso()
-    rows: List[Row] = []
-
-    for wrapper in soup.select("div.ff-wrapper"):
-        a = wrapper.select_one(f'div.ff-row-name a[href^="/{origin}-"]')
-        if not a:
+    root = lxml.html.fromstring(html)
+    scraped_at = sys.intern(now_iso())
+    # dedupe (origin, dest, airline) w locie: późniejszy wiersz nadpisuje wcześniejszy
+    uniq: Dict[Tuple[str, str, str], Row] = {}
+    prefix = f"/{origin}-"
+
+    for wrapper in _XP_WRAPPER(root):
+        a = _first(_XP_LINK, wrapper, prefix=prefix)
+        if a is None:
             continue
 
         href = (a.get("href") or "").strip()
-        m = re.match(rf"^/{origin}-([A-Z0-9]{{3}})$", href)
-        if not m:
+        # prefiks gwarantuje XPath; reszta to kod IATA [A-Z0-9]{3}
+        dest_iata = href[len(prefix):]
+        if not (
+            len(dest_iata) == 3
+            and dest_iata.isascii()
+            and dest_iata.isalnum()
+            and dest_iata == dest_iata.upper()
+        ):
             continue
-        dest_iata = m.group(1)
 
-        strong = a.select_one("strong")
-        city = strong.get_text(strip=True) if strong else ""
+        # find() zatrzymuje się na pierwszym trafieniu, bez budowania listy wyników
+        strong = a.find(".//strong")
+        city = _text(strong) if strong is not None else ""
 
         dest_country_iso2, dest_airport_name = extract_country_and_airport_from_flag(wrapper)
 
-        airline_img = wrapper.select_one("div.ff-row-airline img.ff-image-airline")
-        airline_name = (airline_img.get("alt") or "").strip() if airline_img else ""
-        airline_logo_url = (airline_img.get("src") or "").strip() if airline_img else ""
+        airline_img = _first(_XP_AIRLINE_IMG, wrapper)
+        airline_name = (airline_img.get("alt") or "").strip() if airline_img is not None else ""
+        airline_logo_url = (airline_img.get("src") or "").strip() if airline_img is not None else ""
         airline_iata = extract_airline_iata_from_logo(airline_logo_url)
 
-        fpd_el = wrapper.select_one(".ff-flights-daily, .ff-flights-daily-desktop")
-        flights_per_day_raw = fpd_el.get_text(" ", strip=True) if fpd_el else ""
+        fpd_el = _first(_XP_FPD, wrapper)
+        flights_per_day_raw = _text(fpd_el, " ") if fpd_el is not None else ""
         fpd_min, fpd_max = parse_flights_per_day(flights_per_day_raw)
 
-        dur_el = wrapper.select_one(".ff-row-durationnr, .ff-row-text-durationnr, .ff-row-duration span")
-        duration_raw = dur_el.get_text(" ", strip=True) if dur_el else ""
+        dur_el = _first(_XP_DUR, wrapper)
+        duration_raw = _text(dur_el, " ") if dur_el is not None else ""
         duration_minutes = parse_duration_minutes(duration_raw)
 
-        rows.append(
-            Row(
-                origin_iata=origin,
-                destination_iata=dest_iata,
-                destination_city=city,
-                destination_country_iso2=dest_country_iso2,
-                destination_airport_name=dest_airport_name,
-                airline_name=airline_name,
-                airline_iata=airline_iata,
-                flights_per_day_min=fpd_min,
-                flights_per_day_max=fpd_max,
-                flights_per_day_raw=flights_per_day_raw,
-                duration_minutes=duration_minutes,
-                duration_raw=duration_raw,
-                airline_logo_url=airline_logo_url,
-                route_url="https://www.flightsfrom.com" + href,
-                scraped_at=scraped_at,
-            )
+        uniq[(origin, dest_iata, airline_iata or airline_name)] = Row(
+            origin_iata=origin,
+            destination_iata=dest_iata,
+            destination_city=city,
+            destination_country_iso2=dest_country_iso2,
+            destination_airport_name=dest_airport_name,
+            airline_name=airline_name,
+            airline_iata=airline_iata,
+            flights_per_day_min=fpd_min,
+            flights_per_day_max=fpd_max,
+            flights_per_day_raw=flights_per_day_raw,
+            duration_minutes=duration_minutes,
+            duration_raw=duration_raw,
+            airline_logo_url=airline_logo_url,
+            route_url="https://www.flightsfrom.com" + href,
+            scraped_at=scraped_at,
         )
 
-    # dedupe (origin, dest, airline)
-    uniq = {}
-    for r in rows:
-        key = (r.origin_iata, r.destination_iata, r.airline_iata or r.airline_name)
-        uniq[key] = r
-
     return list(uniq.values())
 
 
-def rows_to_csv(rows: List[Row]) -> str:
-    out = io.StringIO()
+_SORT_KEY = attrgetter("destination_iata", "airline_iata", "airline_name")
+
+
+def write_rows_csv(rows: List[Row], path: Path) -> None:
     fieldnames = [
         "origin_iata",
         "destination_iata",
@@ -209,29 +297,73 @@ def rows_to_csv(rows: List[Row]) -> str:
         "duration_raw",
         "airline_logo_url",
     ]
-    w = csv.DictWriter(out, fieldnames=fieldnames)
-    w.writeheader()
-    for r in sorted(rows, key=lambda x: (x.destination_iata, x.airline_iata, x.airline_name)):
-        w.writerow(
-            {
-                "origin_iata": r.origin_iata,
-                "destination_iata": r.destination_iata,
-                "destination_city": r.destination_city,
-                "destination_country_iso2": r.destination_country_iso2,
-                "destination_airport_name": r.destination_airport_name,
-                "airline_name": r.airline_name,
-                "airline_iata": r.airline_iata,
-                "flights_per_day_min": "" if r.flights_per_day_min is None else r.flights_per_day_min,
-                "flights_per_day_max": "" if r.flights_per_day_max is None else r.flights_per_day_max,
-                "duration_minutes": "" if r.duration_minutes is None else r.duration_minutes,
-                "route_url": r.route_url,
-                "scraped_at": r.scraped_at,
-                "flights_per_day_raw": r.flights_per_day_raw,
-                "duration_raw": r.duration_raw,
-                "airline_logo_url": r.airline_logo_url,
-            }
+    with path.open("w", encoding="utf-8", newline="", buffering=1 << 20) as f:
+        w = csv.writer(f)
+        w.writerow(fieldnames)
+        w.writerows(
+            (
+                r.origin_iata,
+                r.destination_iata,
+                r.destination_city,
+                r.destination_country_iso2,
+                r.destination_airport_name,
+                r.airline_name,
+                r.airline_iata,
+                "" if r.flights_per_day_min is None else r.flights_per_day_min,
+                "" if r.flights_per_day_max is None else r.flights_per_day_max,
+                "" if r.duration_minutes is None else r.duration_minutes,
+                r.route_url,
+                r.scraped_at,
+                r.flights_per_day_raw,
+                r.duration_raw,
+                r.airline_logo_url,
+            )
+            for r in sorted(rows, key=_SORT_KEY)
         )
-    return out.getvalue()
+
+
+def write_error(out_dir: Path, airport: str, message: str) -> None:
+    print(f"[ERROR] {airport}: {message}", file=sys.stderr)
+    # Nie wywracaj całej paczki, ale sygnalizuj błąd kodem wyjścia
+    # (na końcu zsumujemy statusy)
+    (out_dir / f"{airport}.error.txt").write_text(message, encoding="utf-8")
+
+
+def scrape_airports(airports: queue.Queue[str], out_dir: Path) -> int:
+    # Playwright sync API jest związane z wątkiem, który je uruchomił,
+    # więc każdy wątek ma własną przeglądarkę; jedna strona, wiele lotnisk
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        # żądania obsłużone przez service workera omijają ctx.route (block_unneeded)
+        ctx = browser.new_context(user_agent=UA, locale="en-US", service_workers="block")
+        ctx.route("**/*", block_unneeded)
+        page = ctx.new_page()
+        page.set_default_timeout(DEFAULT_TIMEOUT_MS)
+        page.set_default_navigation_timeout(NAVIGATION_TIMEOUT_MS)
+        errors = 0
+
+        # wątki biorą lotniska ze wspólnej kolejki, więc wolne lotnisko nie blokuje reszty
+        while True:
+            try:
+                airport = airports.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                html = fetch_rendered_html(page, airport)
+                rows = parse_rows(html, airport)
+                out_path = out_dir / f"{airport}.csv"
+                write_rows_csv(rows, out_path)
+                # usuń ewentualny error.txt z poprzedniego uruchomienia
+                (out_dir / f"{airport}.error.txt").unlink(missing_ok=True)
+                print(f"[OK] {airport}: rows={len(rows)} file={out_path}", file=sys.stderr)
+            except Exception as e:
+                errors += 1
+                write_error(out_dir, airport, str(e))
+
+        ctx.close()
+        browser.close()
+
+    return errors
 
 
 def main() -> int:
@@ -246,39 +378,45 @@ def main() -> int:
         default="out",
         help="Output directory for CSVs (default: out)",
     )
+    ap.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help=f"Number of airports scraped in parallel (default: {WORKERS})",
+    )
     args = ap.parse_args()
 
-    airports = [a.strip().upper() for a in args.airports.split(",") if a.strip()]
+    # bez duplikatów: dwa wątki nie mogą pisać do tego samego {airport}.csv
+    airports = list(dict.fromkeys(a.strip().upper() for a in args.airports.split(",") if a.strip()))
     out_dir = Path(args.out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    # Playwright: jedna przeglądarka, jedna strona, wiele lotnisk (szybciej i stabilniej)
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        ctx = browser.new_context(user_agent=UA, locale="en-US")
-        page = ctx.new_page()
-
-        for airport in airports:
+    todo: queue.Queue[str] = queue.Queue()
+    for airport in airports:
+        todo.put(airport)
+
+    # każde lotnisko ma osobny CSV, więc wątki nic poza kolejką nie współdzielą
+    workers = max(1, min(args.workers, len(airports)))
+    errors = 0
+    worker_error = ""
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(scrape_airports, todo, out_dir) for _ in range(workers)]
+        for f in futures:
             try:
-                html = fetch_rendered_html(page, airport)
-                rows = parse_rows(html, airport)
-                csv_text = rows_to_csv(rows)
-                out_path = out_dir / f"{airport}.csv"
-                out_path.write_text(csv_text, encoding="utf-8")
-                print(f"[OK] {airport}: rows={len(rows)} file={out_path}", file=sys.stderr)
+                errors += f.result()
             except Exception as e:
-                print(f"[ERROR] {airport}: {e}", file=sys.stderr)
-                # Nie wywracaj całej paczki, ale sygnalizuj błąd kodem wyjścia
-                # (na końcu zsumujemy statusy)
-                (out_dir / f"{airport}.error.txt").write_text(str(e), encoding="utf-8")
-
-        ctx.close()
-        browser.close()
-
-    # jeśli są error.txt, zwróć 2
-    if any(out_dir.glob("*.error.txt")):
-        return 2
-    return 0
+                # np. przeglądarka się nie uruchomiła
+                print(f"[ERROR] worker: {e}", file=sys.stderr)
+                worker_error = str(e)
+                errors += 1
+
+    # lotniska, których żaden wątek nie zdążył wziąć
+    while not todo.empty():
+        errors += 1
+        write_error(out_dir, todo.get_nowait(), f"not scraped, worker failed: {worker_error}")
+
+    # jeśli któreś lotnisko się nie udało, zwróć 2
+    return 2 if errors else 0
 
 
 if __name__ == "__main__":